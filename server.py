@@ -1,23 +1,90 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Response
-from fastapi.responses import FileResponse
-import threading
+from pydantic import BaseModel
+import base64
+import fcntl
+import mmap
+import os
 
-app = FastAPI()
-counter = 0
-counter_lock = threading.Lock()
+# Hit counter shared by all worker processes: a fixed-size file mapped into memory
+# with one 8-byte slot per worker. Each worker claims a slot by locking its byte
+# range and only ever increments that slot, so hits need no lock or syscall. The
+# routes are async, so within a worker only the event loop thread writes. /counter
+# sums the slots. The OS drops the lock when a worker exits, so a restarted worker
+# reuses the free slot and keeps its count.
+COUNTER_FILE = os.environ.get("TRACK_COUNTER_FILE", "track_counter.bin")
+MAX_WORKERS = 64
+_slots = None
+_slot = None
+
+def claim_counter_slot():
+    global _slots, _slot
+    fd = os.open(COUNTER_FILE, os.O_RDWR | os.O_CREAT, 0o644)
+    size = MAX_WORKERS * 8
+    if os.fstat(fd).st_size < size:
+        os.ftruncate(fd, size)
+    for slot in range(MAX_WORKERS):
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 8, slot * 8)
+        except OSError:
+            continue
+        # Keep fd open: closing it would release the slot lock
+        _slots = memoryview(mmap.mmap(fd, size)).cast("Q")
+        _slot = slot
+        return
+    os.close(fd)
+    raise RuntimeError(f"All {MAX_WORKERS} counter slots in {COUNTER_FILE} are in use; run at most {MAX_WORKERS} workers.")
+
+# Claim the slot when a worker starts serving, not in the process that only
+# supervises the workers
+@asynccontextmanager
+async def lifespan(app):
+    claim_counter_slot()
+    yield
+
+app = FastAPI(lifespan=lifespan)
+
+# Declared return types let FastAPI serialize responses straight to JSON bytes with Pydantic
+class Message(BaseModel):
+    message: str
+
+# Load the tracking image once instead of opening it on every request.
+# Fall back to a built-in 1x1 transparent PNG if track.png is missing.
+if os.path.exists("track.png"):
+    with open("track.png", "rb") as f:
+        _PIXEL = f.read()
+else:
+    _PIXEL = base64.b64decode("iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAAC0lEQVR42mNgAAIAAAUAAen63NgAAAAASUVORK5CYII=")
+# Stop clients and proxies from caching the pixel so every open is counted
+_PIXEL_HEADERS = {"Cache-Control": "no-store"}
+
+def count_hit():
+    _slots[_slot] += 1
+
+def read_counter():
+    return sum(_slots)
 
 @app.get("/")
-async def root():
-    return {"message": "tracking your emails!"}
+async def root() -> Message:
+    return Message(message="tracking your emails!")
 
 @app.get("/track.png")
 async def track():
-    global counter
-    with counter_lock:
-        counter += 1
-    # Return the tracking image file
-    return FileResponse("track.png", media_type="image/png")
+    count_hit()
+    # Return the cached tracking image
+    return Response(content=_PIXEL, media_type="image/png", headers=_PIXEL_HEADERS)
 
 @app.get("/counter")
-async def show_counter():
-    return {"message": f"Image has been accessed {counter} times."}
\ No newline at end of file
+async def show_counter() -> Message:
+    return Message(message=f"Image has been accessed {read_counter()} times.")
+
+# Run with uvloop and httptools, one worker per CPU by default. Equivalent to
+#     uvicorn server:app --host 0.0.0.0 --port 80 --workers N --loop uvloop --http httptools
+# Either way the workers share the counter through COUNTER_FILE.
+if __name__ == "__main__":
+    import uvicorn
+
+    workers = int(os.environ.get("WORKERS", os.cpu_count() or 1))
+    if workers > MAX_WORKERS:
+        raise SystemExit(f"WORKERS must be at most {MAX_WORKERS}.")
+    uvicorn.run("server:app", host="0.0.0.0", port=80, workers=workers, loop="uvloop", http="httptools")
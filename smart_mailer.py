@@ -4,7 +4,7 @@ Smart Mailer Script with Email Sending and Tracking Functionality
 This script automates the process of sending customized emails to a list of recipients from a CSV file.
 Each email can be customized with recipient-specific details (like name and department) and includes 
 a tracking pixel to monitor if the email is opened. The script also includes a counter feature to 
-display tracking information and delay control to avoid sending emails too quickly.
+display tracking information and rate limiting to avoid sending emails too quickly.
 
 Usage:
     Run the script with one of the following actions:
@@ -17,14 +17,18 @@ Example:
 """
 
 import os
-import smtplib
+import asyncio
 import time
 import csv
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+import io
+import base64
+from email.header import Header
 import argparse
+import aiosmtplib
 import requests
+from requests.adapters import HTTPAdapter
 import re
+import string
 import urllib3
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
@@ -33,10 +37,40 @@ SMTP_SERVER = 'smtp.gmail.com'
 SMTP_PORT = 587
 TRACKING_IMAGE_URL = 'http://13.215.200.90/track.png'
 COUNTER_URL = 'http://13.215.200.90/counter'
-DELAY_BETWEEN_EMAILS = 5  # Delay in seconds to avoid spam
+TRACKING_IMAGE_TAG = f'<img src="{TRACKING_IMAGE_URL}" width="1" height="1" alt=""/>'
+MAX_EMAILS_PER_SECOND = 1  # Recipients per second (across all connections) to avoid spam
+SMTP_POOL_SIZE = 4  # Number of concurrent SMTP sessions used to send emails
+RECIPIENTS_PER_MESSAGE = 50  # Max recipients sharing one message when the body is not personalized
+CSV_BUFFER_SIZE = 8 * 1024 * 1024  # Read buffer for recipient CSV files
+MAX_EMAILS_PER_CONNECTION = 1000  # Reconnect after this many emails on one SMTP session
+ABORT_MIN_ATTEMPTS = 30  # SMTP sends to attempt before the failure rate can abort the batch
+ABORT_FAILURE_RATE = 1 / 3  # Abort the batch once this fraction of attempted sends has failed
+
+# Shared HTTP session so requests to the tracking server reuse connections
+HTTP_SESSION = requests.Session()
+HTTP_SESSION.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=16))
+HTTP_SESSION.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
+# Placeholder tokens spliced into the serialized email for each recipient
+TO_TOKEN = '\x00TO\x00'
+NAME_TOKEN = '\x00NAME\x00'
+DEPARTMENT_TOKEN = '\x00DEPARTMENT\x00'
 
 # Regular expression for validating email format
 EMAIL_REGEX = r'^[\w\.-]+@[a-zA-Z\d\.-]+\.[a-zA-Z]{2,}$'
+EMAIL_PATTERN = re.compile(EMAIL_REGEX)
+
+# Required leading fields of the recipient CSV file
+CSV_FIELDS = ['email', 'name', 'department_code']
+
+# Required elements of the email template, in the order they must appear
+# #name# is optional: without it everyone in a department gets the same email
+TEMPLATE_ELEMENTS = ["<html>", "<body>", "#name#", "#department#", "</body>", "</html>"]
+UNNAMED_TEMPLATE_ELEMENTS = [element for element in TEMPLATE_ELEMENTS if element != "#name#"]
+# Each atomic group jumps to the first occurrence of the next element and never
+# backtracks into it, so a failed match stays a single linear scan
+TEMPLATE_PATTERN = re.compile(''.join(rf'(?>[\s\S]*?{re.escape(element)})' for element in TEMPLATE_ELEMENTS))
+UNNAMED_TEMPLATE_PATTERN = re.compile(''.join(rf'(?>[\s\S]*?{re.escape(element)})' for element in UNNAMED_TEMPLATE_ELEMENTS))
 
 
 # Function to check email validity
@@ -50,7 +84,7 @@ def is_valid_email(email):
     Returns:
         bool: True if valid, False otherwise.
     """
-    return re.match(EMAIL_REGEX, email) is not None
+    return EMAIL_PATTERN.match(email) is not None
 
 
 # Function to check email validity
@@ -88,7 +122,7 @@ def check_txt_file():
 # Function to check txt file extension
 def check_txt_file_extension(file_path):
     """
-    Checks if a text file  has the required HTML elements.
+    Checks if a text file  has the required HTML elements. #name# is optional.
 
     Args:
         file_path (str): Path to the text file.
@@ -106,7 +140,13 @@ def check_txt_file_extension(file_path):
     
     with open(file_path, 'r') as file:
         content = file.read()
-        required_elements = ["<html>", "<body>", "#name#", "#department#", "</body>", "</html>"]
+        if '#name#' in content:
+            required_elements, pattern = TEMPLATE_ELEMENTS, TEMPLATE_PATTERN
+        else:
+            required_elements, pattern = UNNAMED_TEMPLATE_ELEMENTS, UNNAMED_TEMPLATE_PATTERN
+        # Check all elements in a single scan; only look for the missing ones to report them
+        if pattern.match(content):
+            return True
         start_index = 0
         list_of_missing_elements = ""
         flag = False
@@ -121,6 +161,39 @@ def check_txt_file_extension(file_path):
         return True
     
 
+# Function to open a CSV file for reading
+def open_csv(file_path):
+    """
+    Opens a CSV file as UTF-8 text over a large read buffer.
+
+    Args:
+        file_path (str): Path to the CSV file.
+
+    Returns:
+        io.TextIOWrapper: The opened file, ready for csv.reader.
+    """
+    raw = open(file_path, 'rb', buffering=CSV_BUFFER_SIZE)
+    # utf-8-sig also strips the byte order mark some spreadsheet apps add
+    return io.TextIOWrapper(raw, encoding='utf-8-sig', newline='')
+
+
+# Function to check the CSV header
+def check_csv_header(header):
+    """
+    Checks that a CSV header starts with the required fields.
+
+    Args:
+        header (list): Field names from the first row of the CSV file, or None if empty.
+
+    Returns:
+        bool: True if valid, False otherwise.
+    """
+    if header is None or header[:3] != CSV_FIELDS:
+        print("The first 3 fields are not in the expected order/incorrect field name.")
+        return False
+    return True
+
+
 # Function to check CSV validity
 def check_csv_file_validity(file_path):
     """
@@ -140,14 +213,8 @@ def check_csv_file_validity(file_path):
         print("File does not exist.")
         return False
     
-    with open(file_path, 'r') as file:
-        reader = csv.DictReader(file)
-        field_names = reader.fieldnames
-        expected_fields = ['email', 'name', 'department_code']
-        if field_names[:3] != expected_fields:
-            print("The first 3 fields are not in the expected order/incorrect field name.")
-            return False
-    return True
+    with open_csv(file_path) as file:
+        return check_csv_header(next(csv.reader(file), None))
 
 
 # Function to check CSV file
@@ -169,25 +236,28 @@ def check_csv_file():
 # Function to read CSV and filter based on department code
 def read_csv(file_path, department_code):
     """
-    Reads and filters recipients based on department code.
+    Lazily reads and filters recipients based on department code.
 
     Args:
         file_path (str): Path to the CSV file.
         department_code (str): Department code or 'all' for all departments.
 
-    Returns:
-        list: List of valid recipients.
+    Yields:
+        tuple: (email, name, department_code) for each valid recipient.
     """
-    filtered_list = []
-    with open(file_path, 'r') as file:
-        reader = csv.DictReader(file)
+    with open_csv(file_path) as file:
+        reader = csv.reader(file)
+        if not check_csv_header(next(reader, None)):
+            return
         for row in reader:
-            if department_code == 'all' or row['department_code'] == department_code:
-                if is_valid_email(row['email']):  # Check if email is valid
-                    filtered_list.append(row)
+            if len(row) < 3:
+                continue
+            email, name, department = row[0], row[1], row[2]
+            if department_code == 'all' or department == department_code:
+                if is_valid_email(email):  # Check if email is valid
+                    yield email, name, department
                 else:
-                    print(f"Invalid email format: {row['email']} - Skipping")
-    return filtered_list
+                    print(f"Invalid email format: {email} - Skipping")
 
 
 # Function to read subject and body from a text file
@@ -207,52 +277,417 @@ def read_email_template(file_path):
         body = content[1]
     return subject, body
 
-# Function to send email
-def send_email(to_email, name, department, subject, body, smtp_user, smtp_password):
+# Function to compile the email body template
+def compile_body_template(body):
     """
-    Sends a customized email to a single receipient.
+    Converts the #name#/#department# placeholders and appends the tracking pixel,
+    producing a template that only needs to be built once per batch.
+
+    Args:
+        body (str): Email body read from the template file.
+
+    Returns:
+        string.Template: Template with $name and $department placeholders.
+    """
+    body = body.replace('$', '$$').replace('#name#', '${name}').replace('#department#', '${department}')
+    return string.Template(body + TRACKING_IMAGE_TAG)
+
+
+# Function to open an SMTP session
+async def connect_smtp(smtp_user, smtp_password):
+    """
+    Opens an SMTP session, upgrades it to TLS and logs in.
 
     Args:
-        to_email (str): Recipient's email address.
-        name (str): Recipient's name.
-        department (str): Recipient's department code.
-        subject (str): Email subject.
-        body (str): Email body.
         smtp_user (str): Sender's email address.
         smtp_password (str): Sender's email password.
 
     Returns:
-        bool: True if email sent successfully, False otherwise.
+        aiosmtplib.SMTP: The authenticated SMTP session.
     """
+    server = aiosmtplib.SMTP(hostname=SMTP_SERVER, port=SMTP_PORT, start_tls=True)
+    await server.connect()
     try:
-        # Use the predefined tracking URL
-        tracking_url = TRACKING_IMAGE_URL
-        msg = MIMEMultipart()
-        msg['From'] = smtp_user
-        msg['To'] = to_email
-        msg['Subject'] = subject
-        
-        # Replace placeholders and include tracking URL
-        body = body.replace('#name#', name).replace('#department#', department)
-        body += f'<img src="{tracking_url}" width="1" height="1" alt=""/>'
-        
-        msg.attach(MIMEText(body, 'html'))
+        await server.login(smtp_user, smtp_password)
+    except Exception:
+        server.close()
+        raise
+    return server
 
-        # Connect to the server and send the email
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
-            server.starttls()
-            server.login(smtp_user, smtp_password)
-            server.sendmail(smtp_user, to_email, msg.as_string())
-        return True
-    except Exception as e:
-        print(f"Failed to send email to {to_email}: {e}")
+
+# Function to close an SMTP session
+async def close_smtp(server):
+    """
+    Closes an SMTP session, ignoring errors from an already dropped connection.
+
+    Args:
+        server (aiosmtplib.SMTP): The SMTP session to close.
+    """
+    try:
+        await server.quit()
+    except (aiosmtplib.SMTPException, OSError):
+        server.close()
+
+
+# Function to check if an SMTP session is still usable
+async def is_connection_alive(server):
+    """
+    Checks if an SMTP session is still open with a NOOP command.
+
+    Args:
+        server (aiosmtplib.SMTP): The SMTP session to check.
+
+    Returns:
+        bool: True if the session responded, False otherwise.
+    """
+    if not server.is_connected:
+        return False
+    try:
+        return (await server.noop()).code == 250
+    except (aiosmtplib.SMTPException, OSError):
         return False
 
 
-# Function to send emails with a delay and report results
+# Pool of SMTP sessions shared by the sending tasks
+class SMTPConnectionPool:
+    """
+    Pool of authenticated SMTP sessions shared by concurrent sending tasks.
+
+    Sessions are opened lazily, recycled after MAX_EMAILS_PER_CONNECTION emails
+    and replaced when they fail a health check.
+    """
+
+    def __init__(self, size, smtp_user, smtp_password):
+        """
+        Args:
+            size (int): Maximum number of open SMTP sessions.
+            smtp_user (str): Sender's email address.
+            smtp_password (str): Sender's email password.
+        """
+        self._smtp_user = smtp_user
+        self._smtp_password = smtp_password
+        self._slots = asyncio.Queue()
+        for _ in range(size):
+            self._slots.put_nowait((None, 0))
+
+    async def acquire(self):
+        """
+        Takes a healthy session out of the pool, connecting if needed.
+
+        Returns:
+            tuple: (server, sent) with the SMTP session and the number of emails already sent on it.
+        """
+        server, sent = await self._slots.get()
+        try:
+            if server is not None and (sent >= MAX_EMAILS_PER_CONNECTION or not await is_connection_alive(server)):
+                await close_smtp(server)
+                server = None
+            if server is None:
+                server = await connect_smtp(self._smtp_user, self._smtp_password)
+                sent = 0
+        except BaseException:
+            self._slots.put_nowait((None, 0))
+            raise
+        return server, sent
+
+    def release(self, server, sent):
+        """
+        Returns a session to the pool.
+
+        Args:
+            server (aiosmtplib.SMTP): The SMTP session.
+            sent (int): Number of emails sent on the session so far.
+        """
+        self._slots.put_nowait((server, sent))
+
+    def discard(self, server):
+        """
+        Closes a broken session and frees its slot for a new one.
+
+        Args:
+            server (aiosmtplib.SMTP): The SMTP session to drop.
+        """
+        server.close()
+        self._slots.put_nowait((None, 0))
+
+    async def close(self):
+        """
+        Closes every open session in the pool.
+        """
+        while not self._slots.empty():
+            server, _ = self._slots.get_nowait()
+            if server is not None:
+                await close_smtp(server)
+
+
+# Global rate limiter shared by the sending tasks
+class RateLimiter:
+    """
+    Spaces recipients at least 1/rate seconds apart across all tasks, only
+    waiting when sends arrive faster than the rate.
+    """
+
+    def __init__(self, rate):
+        """
+        Args:
+            rate (float): Maximum number of recipients per second.
+        """
+        self._interval = 1 / rate
+        self._next_send = time.monotonic()
+
+    async def acquire(self, recipients=1):
+        """
+        Reserves send slots for an email and waits until they are reached.
+
+        Args:
+            recipients (int): Number of recipients of the email.
+        """
+        now = time.monotonic()
+        wait = self._next_send - now
+        self._next_send = max(now, self._next_send) + recipients * self._interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+# Function to build the serialized email once per batch
+def build_message(subject, body, smtp_user):
+    """
+    Builds and serializes the email once, leaving placeholder tokens for the
+    recipient-specific To header, name and department.
+
+    Args:
+        subject (str): Email subject.
+        body (string.Template): Compiled email body template.
+        smtp_user (str): Sender's email address.
+
+    Returns:
+        bytes: The serialized email containing the placeholder tokens.
+    """
+    # Only non-ASCII subjects need RFC 2047 encoding
+    if not subject.isascii():
+        subject = Header(subject, 'utf-8').encode(linesep='\r\n')
+
+    # The email is a single HTML part sent as 8bit, so names and departments
+    # can be spliced into the raw bytes later. Servers without 8BITMIME get a
+    # 7-bit copy from make_7bit_safe after splicing.
+    headers = (
+        f"From: {smtp_user}\r\n"
+        f"To: {TO_TOKEN}\r\n"
+        f"Subject: {subject}\r\n"
+        "MIME-Version: 1.0\r\n"
+        "Content-Type: text/html; charset=\"utf-8\"\r\n"
+        "Content-Transfer-Encoding: 8bit\r\n"
+        "\r\n"
+    )
+    body = body.substitute(name=NAME_TOKEN, department=DEPARTMENT_TOKEN)
+    return (headers + body).encode('utf-8')
+
+
+# Function to make a serialized email safe for servers without 8BITMIME
+def make_7bit_safe(message):
+    """
+    Re-encodes an 8bit email from build_message for servers that only accept
+    7-bit data, after the recipient's details have been spliced in.
+
+    Args:
+        message (bytes): Serialized email with its placeholders filled in.
+
+    Returns:
+        bytes: The email labelled 7bit if its body is ASCII, otherwise with a base64 body.
+    """
+    headers, body = message.split(b'\r\n\r\n', 1)
+    if body.isascii():
+        encoding = b'7bit'
+    else:
+        encoding = b'base64'
+        body = base64.encodebytes(body).replace(b'\n', b'\r\n')
+    headers = headers.replace(b'Content-Transfer-Encoding: 8bit', b'Content-Transfer-Encoding: ' + encoding)
+    return headers + b'\r\n\r\n' + body
+
+
+# Function to send email
+async def send_email(server, to_emails, name, department, message, smtp_user):
+    """
+    Sends a customized email over an open SMTP session. Several recipients can
+    share one message when the body rendered for them is identical.
+
+    Args:
+        server (aiosmtplib.SMTP): Authenticated SMTP session.
+        to_emails (list): Recipients' email addresses.
+        name (str): Recipient's name.
+        department (str): Recipient's department code.
+        message (bytes): Serialized email from build_message.
+        smtp_user (str): Sender's email address.
+
+    Returns:
+        dict: Recipients refused by the server, mapped to the server's reply.
+    """
+    # Don't disclose the other recipients of a shared message
+    to_header = to_emails[0] if len(to_emails) == 1 else 'undisclosed-recipients:;'
+
+    # Fill in the recipient's details; the tracking pixel is already in the message
+    message = (message.replace(TO_TOKEN.encode(), to_header.encode('utf-8'))
+                      .replace(NAME_TOKEN.encode(), name.encode('utf-8'))
+                      .replace(DEPARTMENT_TOKEN.encode(), department.encode('utf-8')))
+
+    if server.supports_extension('8bitmime'):
+        mail_options = ['BODY=8BITMIME']
+    else:
+        message = make_7bit_safe(message)
+        mail_options = []
+    refused, _ = await server.sendmail(smtp_user, to_emails, message, mail_options=mail_options)
+    return refused
+
+
+# Function to send email to recipients using the pool
+async def send_to_recipients(pool, limiter, to_emails, name, department, message, smtp_user):
+    """
+    Sends a customized email to one or more recipients over a pooled SMTP session,
+    retrying once on a fresh session if the connection has dropped.
+
+    Args:
+        pool (SMTPConnectionPool): Pool of SMTP sessions.
+        limiter (RateLimiter): Global send rate limiter.
+        to_emails (list): Recipients' email addresses.
+        name (str): Recipient's name.
+        department (str): Recipient's department code.
+        message (bytes): Serialized email from build_message.
+        smtp_user (str): Sender's email address.
+
+    Returns:
+        int: Number of recipients the email was sent to.
+    """
+    recipients = ", ".join(to_emails)
+    for attempt in range(2):
+        try:
+            server, sent = await pool.acquire()
+        except Exception as e:
+            print(f"Failed to send email to {recipients}: {e}")
+            return 0
+
+        try:
+            await limiter.acquire(len(to_emails))
+            refused = await send_email(
+                server=server,
+                to_emails=to_emails,
+                name=name,
+                department=department,
+                message=message,
+                smtp_user=smtp_user
+            )
+        except (aiosmtplib.SMTPServerDisconnected, aiosmtplib.SMTPConnectError, OSError) as e:
+            pool.discard(server)
+            if attempt == 1:
+                print(f"Failed to send email to {recipients}: {e}")
+                return 0
+            continue
+        except Exception as e:
+            pool.release(server, sent)
+            print(f"Failed to send email to {recipients}: {e}")
+            return 0
+
+        pool.release(server, sent + 1)
+        for to_email in to_emails:
+            if to_email in refused:
+                print(f"Failed to send email to {to_email}: {refused[to_email]}")
+            else:
+                print(f"Email sent to {to_email}")
+        return len(to_emails) - len(refused)
+    return 0
+
+
+# Function to group recipients that get an identical email
+def group_recipients(recipients, personalized):
+    """
+    Groups recipients into the emails that have to be sent.
+
+    Args:
+        recipients (iterable): (email, name, department_code) tuples from read_csv.
+        personalized (bool): False if every recipient in a department gets the same email.
+
+    Yields:
+        tuple: (emails, name, department_code) for each email to send.
+    """
+    if personalized:
+        for email, name, department in recipients:
+            yield [email], name, department
+        return
+
+    batches = {}  # Recipients waiting to share an email, keyed by department
+    for email, _, department in recipients:
+        batch = batches.setdefault(department, [])
+        batch.append(email)
+        if len(batch) >= RECIPIENTS_PER_MESSAGE:
+            yield batches.pop(department), '', department
+    for department, batch in batches.items():
+        yield batch, '', department
+
+
+# Function to send emails concurrently and count them per department
+async def send_emails(recipients, message, personalized, smtp_user, smtp_password):
+    """
+    Sends emails to all recipients concurrently over a pool of SMTP sessions,
+    under a global send rate limit. Stops sending once at least
+    ABORT_MIN_ATTEMPTS sends were attempted and ABORT_FAILURE_RATE of them failed.
+    A send is one SMTP transaction, however many recipients it has.
+
+    Args:
+        recipients (iterable): (email, name, department_code) tuples from read_csv.
+        message (bytes): Serialized email from build_message.
+        personalized (bool): False if every recipient in a department gets the same email.
+        smtp_user (str): Sender's email address.
+        smtp_password (str): Sender's email password.
+
+    Returns:
+        dict: Number of emails sent per department code.
+    """
+    pool = SMTPConnectionPool(SMTP_POOL_SIZE, smtp_user, smtp_password)
+    limiter = RateLimiter(MAX_EMAILS_PER_SECOND)
+    in_flight = asyncio.Semaphore(2 * SMTP_POOL_SIZE)
+
+    sent_count = {}
+    tasks = set()
+    attempts = 0
+    failures = 0
+
+    async def send(to_emails, name, department):
+        nonlocal attempts, failures
+        try:
+            sent = await send_to_recipients(pool, limiter, to_emails, name, department, message, smtp_user)
+        finally:
+            in_flight.release()
+        attempts += 1
+        if not sent:
+            failures += 1
+        if sent:
+            sent_count[department] = sent_count.get(department, 0) + sent
+
+    try:
+        for to_emails, name, department in group_recipients(recipients, personalized):
+            # Only read further into the CSV once a send slot is free
+            await in_flight.acquire()
+            if attempts >= ABORT_MIN_ATTEMPTS and failures >= attempts * ABORT_FAILURE_RATE:
+                in_flight.release()
+                print(f"Aborting batch: {failures} of {attempts} sends failed.")
+                break
+            task = asyncio.create_task(send(to_emails, name, department))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks)
+    finally:
+        await pool.close()
+    return sent_count
+
+
+# Function to send emails with a rate limit and report results
 def send_emails_with_report(csv_file, department_code, email_template_path, smtp_user, smtp_password):
     """
-    Sends emails to all filtered recipients with a delay and prints a report.
+    Sends emails to all filtered recipients over a pool of SMTP sessions with a
+    global send rate limit and prints a report.
+
+    If the template does not use #name#, recipients of the same department get an
+    identical email, so they are grouped into messages of up to
+    RECIPIENTS_PER_MESSAGE recipients each.
 
     Args:
         csv_file (str): Path to the CSV file.
@@ -262,23 +697,11 @@ def send_emails_with_report(csv_file, department_code, email_template_path, smtp
         smtp_password (str): Sender's email password.
     """
     recipients = read_csv(csv_file, department_code)
-    subject, body_template = read_email_template(email_template_path)
+    subject, body = read_email_template(email_template_path)
+    message = build_message(subject, compile_body_template(body), smtp_user)
+    personalized = '#name#' in body
 
-    sent_count = {}
-    for recipient in recipients:
-        email_sent = send_email(
-            to_email=recipient['email'],
-            name=recipient['name'],
-            department=recipient['department_code'],
-            subject=subject,
-            body=body_template,
-            smtp_user=smtp_user,
-            smtp_password=smtp_password
-        )
-        if email_sent:
-            sent_count[recipient['department_code']] = sent_count.get(recipient['department_code'], 0) + 1
-            print(f"Email sent to {recipient['email']}")
-            time.sleep(DELAY_BETWEEN_EMAILS)
+    sent_count = asyncio.run(send_emails(recipients, message, personalized, smtp_user, smtp_password))
 
     # Print report
     print("\nReport:")
@@ -292,7 +715,7 @@ def display_counter():
     """
     try:
         # Pass verify=False to skip SSL verification
-        response = requests.get(COUNTER_URL, verify=False)
+        response = HTTP_SESSION.get(COUNTER_URL, verify=False)
         if response.status_code == 200:
             print(response.json()['message'])
         else:
@@ -0,0 +1,92 @@
+import asyncio
+import email
+import email.policy
+import unittest
+from unittest import mock
+
+import smart_mailer
+
+
+def fake_sender(failing_calls):
+    """Returns a send_to_recipients stand-in whose given calls (1-based) fail at once."""
+    calls = []
+
+    async def send_to_recipients(pool, limiter, to_emails, name, department, message, smtp_user):
+        calls.append(list(to_emails))
+        if len(calls) in failing_calls:
+            return 0
+        # Successful sends take a network round trip, so failures are seen first
+        await asyncio.sleep(0.01)
+        return len(to_emails)
+
+    return send_to_recipients, calls
+
+
+class SendEmailsAbortTest(unittest.TestCase):
+
+    def run_batch(self, recipients, personalized, failing_calls):
+        sender, calls = fake_sender(failing_calls)
+        with mock.patch.object(smart_mailer, 'send_to_recipients', sender):
+            sent_count = asyncio.run(smart_mailer.send_emails(
+                recipients, b'', personalized, 'me@example.com', 'password'))
+        return sent_count, calls
+
+    def test_failed_grouped_send_counts_as_one_attempt(self):
+        recipients = [(f'user{i}@example.com', '', 'D1') for i in range(500)]
+        sent_count, calls = self.run_batch(recipients, personalized=False, failing_calls={1})
+        self.assertEqual(len(calls), 10)
+        self.assertEqual(sent_count, {'D1': 450})
+
+    def test_aborts_after_minimum_failed_sends(self):
+        recipients = [(f'user{i}@example.com', 'Name', 'D1') for i in range(200)]
+        sent_count, calls = self.run_batch(recipients, personalized=True, failing_calls=set(range(1, 201)))
+        self.assertEqual(sent_count, {})
+        self.assertGreaterEqual(len(calls), smart_mailer.ABORT_MIN_ATTEMPTS)
+        self.assertLess(len(calls), smart_mailer.ABORT_MIN_ATTEMPTS + 2 * smart_mailer.SMTP_POOL_SIZE + 1)
+
+
+class FakeSMTP:
+    """Records what send_email hands to the server."""
+
+    def __init__(self, extensions):
+        self.extensions = extensions
+
+    def supports_extension(self, name):
+        return name in self.extensions
+
+    async def sendmail(self, sender, recipients, message, mail_options=()):
+        self.message = message
+        self.mail_options = list(mail_options)
+        return {}, 'OK'
+
+
+class SendEmailEncodingTest(unittest.TestCase):
+
+    def send(self, extensions, name):
+        template = smart_mailer.compile_body_template('<html><body>Hello #name#, #department#</body></html>')
+        message = smart_mailer.build_message('Welcome', template, 'me@example.com')
+        server = FakeSMTP(extensions)
+        asyncio.run(smart_mailer.send_email(server, ['you@example.com'], name, 'D1', message, 'me@example.com'))
+        return server
+
+    def test_8bitmime_server_gets_raw_utf8(self):
+        server = self.send({'8bitmime'}, 'Näme')
+        self.assertEqual(server.mail_options, ['BODY=8BITMIME'])
+        self.assertIn('Näme'.encode('utf-8'), server.message)
+
+    def test_7bit_server_gets_base64_body(self):
+        server = self.send(set(), 'Näme')
+        self.assertEqual(server.mail_options, [])
+        self.assertTrue(server.message.isascii())
+        msg = email.message_from_bytes(server.message, policy=email.policy.default)
+        self.assertEqual(msg['Content-Transfer-Encoding'], 'base64')
+        self.assertIn('Hello Näme, D1', msg.get_content())
+
+    def test_7bit_server_gets_ascii_body_as_is(self):
+        server = self.send(set(), 'Name')
+        self.assertIn(b'Content-Transfer-Encoding: 7bit\r\n', server.message)
+        self.assertIn(b'Hello Name, D1', server.message)
+
+
+if __name__ == '__main__':
+    unittest.main()